@@ -9,59 +9,135 @@ Configuration is set via constants at the top of the script.
 """
 
 import os
+import pickle
+import hashlib
+import numpy as np
+import networkx as nx
 import osmnx as ox
-import requests
+import rasterio
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from utils.http_session import create_session
 
 # -----------------------------
 # CONFIGURATION
 # -----------------------------
 CENTER_POINT = (10.299848, 123.871968)  # (lat, lon) for Tisa, Cebu City
 DIST = 200                              # Distance in meters for graph radius
-SRTM_PATH = 'data/srtm.tif'             # Path to SRTM raster for elevation
+SRTM_PATH = 'data/srtm.tif'             # Path to SRTM raster for elevation (ideally a Cloud Optimized GeoTIFF)
+ELEVATION_SOURCE = 'google'             # 'google' (Elevation API) or 'srtm' (sample SRTM_PATH locally)
 OUTPUT_PATH = os.path.join('data', 'road_network.graphml')  # Output GraphML file
+PICKLE_OUTPUT_PATH = os.path.join('data', 'road_network.pkl')  # Binary copy for fast loading in stage 2
+GRAPH_CACHE_DIR = os.path.join('data', 'cache')  # Pickled OSM downloads, keyed by query parameters
+ELEVATION_WORKERS = 8                   # Concurrent Google Elevation API requests
+
+# Reuse OSMnx's own HTTP cache for Overpass/Nominatim responses
+ox.settings.use_cache = True
 
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
+# Shared (cached) HTTP session for Google Elevation API requests
+SESSION = create_session(pool_size=ELEVATION_WORKERS)
+
+
+def _fetch_elevation_batch(batch, api_key):
+    """
+    Fetch elevations for a single batch of (lat, lon) tuples.
+    Returns a list of elevations (meters), with 0 for every location if the request fails.
+    """
+    url = "https://maps.googleapis.com/maps/api/elevation/json"
+    locations = "|".join([f"{lat},{lon}" for lat, lon in batch])
+    params = {"locations": locations, "key": api_key}
+    resp = SESSION.get(url, params=params)
+    if resp.status_code == 200:
+        data = resp.json()
+        if data.get("status") == "OK":
+            return [result["elevation"] for result in data["results"]]
+        print(f"Google Elevation API error: {data.get('status')}")
+    else:
+        print(f"HTTP error from Google Elevation API: {resp.status_code}")
+    return [0] * len(batch)
+
 
 def fetch_elevations_google(coords, api_key):
     """
     Fetch elevations for a list of (lat, lon) tuples using Google Elevation API.
+    Batches are requested concurrently; results are returned in input order.
     Returns a list of elevations (meters).
     """
-    elevations = []
-    url = "https://maps.googleapis.com/maps/api/elevation/json"
     # Google API allows up to 512 locations per request
-    BATCH_SIZE = 100  # Stay well below the limit
-    for i in range(0, len(coords), BATCH_SIZE):
-        batch = coords[i:i+BATCH_SIZE]
-        locations = "|".join([f"{lat},{lon}" for lat, lon in batch])
-        params = {"locations": locations, "key": api_key}
-        resp = requests.get(url, params=params)
-        if resp.status_code == 200:
-            data = resp.json()
-            if data.get("status") == "OK":
-                elevations.extend([result["elevation"] for result in data["results"]])
-            else:
-                print(f"Google Elevation API error: {data.get('status')}")
-                elevations.extend([0] * len(batch))
-        else:
-            print(f"HTTP error from Google Elevation API: {resp.status_code}")
-            elevations.extend([0] * len(batch))
-    return elevations
+    BATCH_SIZE = 500
+    batches = [coords[i:i+BATCH_SIZE] for i in range(0, len(coords), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=ELEVATION_WORKERS) as executor:
+        results = list(executor.map(lambda batch: _fetch_elevation_batch(batch, api_key), batches))
+    return [elev for batch_elevations in results for elev in batch_elevations]
+
+
+def fetch_elevations_raster(coords, raster_path):
+    """
+    Sample elevations for a list of (lat, lon) tuples from a local DEM raster in EPSG:4326.
+    Only the raster blocks containing the points are read, so a tiled Cloud Optimized GeoTIFF
+    keeps I/O proportional to the graph area. Convert once with:
+        rio cogeo create data/srtm.tif data/srtm_cog.tif --overview-level 5 --blocksize 512
+    Returns a list of elevations (meters), with NaN where the raster has no data
+    (NaN survives a GraphML round trip, None would be written as the string "None").
+    """
+    with rasterio.Env(GDAL_CACHEMAX=512), rasterio.open(raster_path, sharing=False) as src:
+        nodata = src.nodata
+        samples = src.sample([(lon, lat) for lat, lon in coords], indexes=1)
+        return [np.nan if nodata is not None and value[0] == nodata else float(value[0])
+                for value in samples]
+
+
+def download_road_network(center_point, dist, network_type='drive'):
+    """
+    Download the OSM road network around center_point.
+    The result is pickled to GRAPH_CACHE_DIR so later runs with the same
+    (center_point, dist, network_type) load it from disk instead of querying Overpass.
+    """
+    key = hashlib.sha1(repr((tuple(center_point), dist, network_type)).encode()).hexdigest()
+    cache_path = os.path.join(GRAPH_CACHE_DIR, f"graph_{key}.pkl")
+    if os.path.exists(cache_path):
+        print(f"Loading cached road network from {cache_path}")
+        try:
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            # Truncated file or pickled under other library versions; download again
+            print(f"Discarding unreadable cached road network {cache_path}: {e}")
+            os.remove(cache_path)
+
+    graph = ox.graph_from_point(center_point, dist=dist, network_type=network_type)
+    os.makedirs(GRAPH_CACHE_DIR, exist_ok=True)
+    tmp_path = cache_path + ".part"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return graph
+
+
+def _as_elevation(value):
+    """
+    Convert a node elevation attribute to float, returning NaN if it is missing or invalid.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
 
 
 def build_road_network(center_point, dist=800, srtm_path=None):
     """
     Downloads and builds a road network graph for a given center point and distance.
-    Adds edge speeds, travel times, and elevation data from Google Elevation API.
+    Adds edge speeds, travel times, and elevation data from Google Elevation API
+    (or from the SRTM raster when ELEVATION_SOURCE is 'srtm').
     Ensures bidirectionality and computes elevation gain for each edge.
     """
     print(f"Building road network for point: {center_point} with dist={dist}m")
     try:
         # Download road network from OSM
-        graph = ox.graph_from_point(center_point, dist=dist, network_type='drive')
+        graph = download_road_network(center_point, dist=dist, network_type='drive')
     except Exception as e:
         print("Error: Could not download road network. Check the coordinates or your internet connection.")
         raise e
@@ -77,36 +153,51 @@ def build_road_network(center_point, dist=800, srtm_path=None):
     graph = ox.add_edge_travel_times(graph)
     print("Added edge speeds and travel times.")
 
-    # Add elevation from Google Elevation API
-    print("Adding elevation using Google Elevation API...")
     node_coords = [(data['y'], data['x']) for node, data in graph.nodes(data=True)]
-    elevations = fetch_elevations_google(node_coords, GOOGLE_API_KEY)
+    if ELEVATION_SOURCE == 'srtm' and srtm_path:
+        # Add elevation by sampling the local SRTM raster
+        print(f"Adding elevation from raster {srtm_path}...")
+        elevations = fetch_elevations_raster(node_coords, srtm_path)
+    else:
+        # Add elevation from Google Elevation API
+        print("Adding elevation using Google Elevation API...")
+        elevations = fetch_elevations_google(node_coords, GOOGLE_API_KEY)
     for (node, data), elev in zip(graph.nodes(data=True), elevations):
         data['elevation'] = elev
     print("Successfully added elevation data to nodes.")
 
     # Make graph bidirectional manually and compute elevation gain
-    edges_to_add = []
-    for u, v, k, data in graph.edges(keys=True, data=True):
-        elev_u = graph.nodes[u].get('elevation', 0)
-        elev_v = graph.nodes[v].get('elevation', 0)
-        try:
-            elev_u = float(elev_u)
-            elev_v = float(elev_v)
-            gain = elev_v - elev_u
-        except (TypeError, ValueError):
-            gain = 0
-        data['distance'] = data.get('length', 0)
-        data['elevation_gain'] = gain
-        # If reverse edge does not exist, add it
-        if not graph.has_edge(v, u, k):
-            rev_data = data.copy()
-            rev_data['elevation_gain'] = -gain
-            edges_to_add.append((v, u, k, rev_data))
-
-    # Add missing reverse edges
-    for v, u, k, rev_data in edges_to_add:
-        graph.add_edge(v, u, key=k, **rev_data)
+    # Node elevations as a float array indexed by node position (missing values become NaN)
+    node_idx = {}
+    elev = np.empty(graph.number_of_nodes(), dtype=np.float64)
+    for i, (n, value) in enumerate(graph.nodes(data='elevation', default=0)):
+        node_idx[n] = i
+        elev[i] = _as_elevation(value)
+    # Structure-of-arrays view of the edges: one vectorized subtraction gives every gain
+    edges = list(graph.edges(keys=True, data=True))
+    u_idx = np.fromiter((node_idx[u] for u, _, _, _ in edges), dtype=np.intp, count=len(edges))
+    v_idx = np.fromiter((node_idx[v] for _, v, _, _ in edges), dtype=np.intp, count=len(edges))
+    # Elevation missing at either end gives a gain of 0
+    edge_gains = np.nan_to_num(elev[v_idx] - elev[u_idx], nan=0.0)
+
+    existing_edges = set(graph.edges(keys=True))
+    distances = {}
+    gains = {}
+    reverse_edges = []
+    for (u, v, k, data), gain in zip(edges, edge_gains.tolist()):
+        distances[(u, v, k)] = data.get('length', 0)
+        gains[(u, v, k)] = gain
+        # If reverse edge does not exist, queue it with the forward attributes and negated gain
+        if (v, u, k) not in existing_edges:
+            existing_edges.add((v, u, k))
+            reverse_edges.append((v, u, k, data))
+            distances[(v, u, k)] = distances[(u, v, k)]
+            gains[(v, u, k)] = -gain
+
+    # Add missing reverse edges, then set distance and elevation gain on all edges in bulk
+    graph.add_edges_from(reverse_edges)
+    nx.set_edge_attributes(graph, distances, 'distance')
+    nx.set_edge_attributes(graph, gains, 'elevation_gain')
 
     print("Processed edge attributes and ensured bidirectionality.")
     return graph
@@ -119,13 +210,15 @@ if __name__ == "__main__":
         if road_network is not None:
             ox.save_graphml(road_network, filepath=OUTPUT_PATH)
             print(f"Graph saved to {OUTPUT_PATH}")
+            # Write to a temporary file first so an interrupted dump never leaves a
+            # newer, truncated pickle that stage 2 would prefer over the GraphML
+            tmp_path = PICKLE_OUTPUT_PATH + ".part"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(road_network, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, PICKLE_OUTPUT_PATH)
+            print(f"Graph saved to {PICKLE_OUTPUT_PATH}")
             # Display node IDs as labels
-            import matplotlib.pyplot as plt
-            import networkx as nx
-            fig, ax = ox.plot_graph(road_network, edge_linewidth=1, edge_color="gray", show=False, close=False)
-            pos = {node: (data['x'], data['y']) for node, data in road_network.nodes(data=True)}
-            node_labels = {node: str(node) for node in road_network.nodes()}
-            nx.draw_networkx_labels(road_network, pos=pos, labels=node_labels, ax=ax, font_size=8, font_color="white")
-            plt.show()
+            from utils.display_graph import display_graph
+            display_graph(road_network)
     except Exception as e:
         print(f"Error: {e}")
@@ -1,12 +1,15 @@
 import os
 import csv
 import time
-import requests
-from shapely.geometry import LineString
+import pickle
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import osmnx as ox
 import networkx as nx
 from dotenv import load_dotenv
-import math
+import numpy as np
+from utils.http_session import create_session
 
 # Load environment variables from .env file
 load_dotenv()
@@ -22,6 +25,13 @@ SPACING_METERS = 10              # Distance between sampled points on each edge
 HEADINGS = [0]                   # List of headings (can be [0, 90, 180, 270] for more coverage)
 PITCH = -20                      # Camera pitch for pavement assessment (negative looks downward)
 OVERWRITE = False                # If True, overwrite existing images
+DEDUP_DECIMALS = 5               # Samples equal after rounding lat/lng to this many decimals (~1 m) share one image
+CHECK_COVERAGE = True            # If True, query the free metadata endpoint before requesting an image
+MAX_WORKERS = 16                 # Number of concurrent download threads
+MAX_IN_FLIGHT = MAX_WORKERS * 4  # Download jobs submitted to the thread pool at any one time
+REQUESTS_PER_SECOND = 10         # Shared request rate across all download threads
+REQUEST_TIMEOUT = 10.0           # Seconds to wait for a Street View response
+METADATA_FLUSH_EVERY = 100       # Flush metadata CSV to disk every N rows
 
 # Ensure the data and image directories exist
 os.makedirs("data", exist_ok=True)
@@ -39,27 +49,77 @@ if not os.path.exists(METADATA_FILE):
         writer.writerow(CSV_HEADER)
 
 
-def sample_points_on_edge(G, u, v, k, data, spacing=10):
+class RateLimiter:
     """
-    Samples points along the edge geometry at fixed spacing (in meters).
-    Returns a list of shapely Point objects.
+    Token-bucket rate limiter shared across download threads.
+    Allows short bursts up to `capacity` requests, then throttles to `rate` requests per second.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request token is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+# Shared (cached) HTTP session; keep-alive connections are reused across requests and threads
+SESSION = create_session(pool_size=MAX_WORKERS)
+
+
+def edge_coordinates(G, u, v, data):
+    """
+    Returns the edge geometry as an (N, 2) NumPy array of (x, y) coordinates.
+    Edges without geometry are treated as a straight line between the node coordinates.
     """
     geom = data.get('geometry')
     if not geom:
-        # If no geometry, use a straight line between node coordinates
-        point_u = (G.nodes[u]['x'], G.nodes[u]['y'])
-        point_v = (G.nodes[v]['x'], G.nodes[v]['y'])
-        geom = LineString([point_u, point_v])
-    length = geom.length
+        return np.array([
+            [G.nodes[u]['x'], G.nodes[u]['y']],
+            [G.nodes[v]['x'], G.nodes[v]['y']],
+        ])
+    return np.asarray(geom.coords)
+
+
+def sample_points_on_edge(coords, spacing=10):
+    """
+    Samples points along the edge coordinates at fixed spacing (in meters).
+    Returns (xs, ys, seg_idx) NumPy arrays, where seg_idx is the index of the
+    geometry segment containing each sampled point.
+    """
+    # Cumulative distance along the line at each vertex
+    seg_len = np.hypot(*np.diff(coords, axis=0).T)
+    cum_len = np.concatenate(([0.0], np.cumsum(seg_len)))
+    length = cum_len[-1]
     if length < spacing:
-        return [geom.interpolate(0.5, normalized=True)]
-    return [geom.interpolate(i * spacing) for i in range(1, int(length // spacing))]
+        distances = np.array([length / 2])
+    else:
+        distances = np.arange(1, int(length // spacing)) * spacing
+    seg_idx = np.clip(np.searchsorted(cum_len, distances, side='right') - 1, 0, len(seg_len) - 1)
+    return np.interp(distances, cum_len, coords[:, 0]), np.interp(distances, cum_len, coords[:, 1]), seg_idx
 
 
-def fetch_street_view_image(lat, lng, heading, api_key=API_KEY, pitch=PITCH):
+def fetch_street_view_image(lat, lng, heading, save_path, api_key=API_KEY, pitch=PITCH, session=SESSION):
     """
-    Fetch image bytes from Google Street View Static API for a given lat/lng/heading.
-    Returns image bytes if successful, else None.
+    Stream an image from Google Street View Static API for a given lat/lng/heading to save_path.
+    The body is written in chunks through a temporary file, so an interrupted download
+    never leaves a truncated image that later runs would skip.
+    Returns True if the image was saved, else False.
     """
     base_url = "https://maps.googleapis.com/maps/api/streetview"
     params = {
@@ -70,116 +130,222 @@ def fetch_street_view_image(lat, lng, heading, api_key=API_KEY, pitch=PITCH):
         'pitch': pitch,
         'key': api_key
     }
-    response = requests.get(base_url, params=params)
-    return response.content if response.status_code == 200 else None
+    with session.get(base_url, params=params, timeout=REQUEST_TIMEOUT, stream=True) as response:
+        if response.status_code != 200:
+            return False
+        tmp_path = save_path + ".part"
+        with open(tmp_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=65536):
+                f.write(chunk)
+    os.replace(tmp_path, save_path)
+    return True
 
 
-def save_image(image_bytes, save_path):
+def fetch_streetview_metadata(lat, lng, api_key=API_KEY, session=SESSION):
     """
-    Save image bytes to disk at the specified path.
+    Check Street View coverage at lat/lng using the Street View Image Metadata API,
+    which is free of charge (image requests are billed even when no imagery exists).
+    Returns True if imagery is available.
     """
-    with open(save_path, 'wb') as f:
-        f.write(image_bytes)
+    base_url = "https://maps.googleapis.com/maps/api/streetview/metadata"
+    params = {
+        'location': f'{lat},{lng}',
+        'key': api_key
+    }
+    response = session.get(base_url, params=params, timeout=REQUEST_TIMEOUT)
+    return response.status_code == 200 and response.json().get('status') == 'OK'
 
 
 def calculate_bearing(lat1, lon1, lat2, lon2):
     """
     Calculate the bearing between two points (in degrees, 0 = north, clockwise).
+    Accepts scalars or NumPy arrays, which are broadcast element-wise.
     """
-    lat1 = math.radians(lat1)
-    lat2 = math.radians(lat2)
-    diff_long = math.radians(lon2 - lon1)
-    x = math.sin(diff_long) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - (
-        math.sin(lat1) * math.cos(lat2) * math.cos(diff_long)
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    diff_long = np.radians(np.subtract(lon2, lon1))
+    x = np.sin(diff_long) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - (
+        np.sin(lat1) * np.cos(lat2) * np.cos(diff_long)
     )
-    initial_bearing = math.atan2(x, y)
-    initial_bearing = math.degrees(initial_bearing)
+    initial_bearing = np.degrees(np.arctan2(x, y))
     compass_bearing = (initial_bearing + 360) % 360
     return compass_bearing
 
 
-def process_graph_and_download(G, sample_spacing=SPACING_METERS):
+def segment_bearings(coords):
     """
-    For each edge in the OSMnx graph G, sample points, download images, and record metadata.
-    Images are stored in road_images/{segment_id}/{index}_{heading}.jpg
-    Metadata is appended to image_metadata.csv
+    Calculate the bearing of every segment of an (N, 2) array of (lon, lat) coordinates
+    in one vectorized call.
+    """
+    return calculate_bearing(coords[:-1, 1], coords[:-1, 0], coords[1:, 1], coords[1:, 0])
+
+
+def download_image(job, limiter):
+    """
+    Download a single Street View image described by `job` (a metadata row).
+    Locations without Street View coverage are skipped when CHECK_COVERAGE is set.
+    Returns the metadata row if the image was saved, else None.
+    """
+    segment_id, u, v, k, i, lat, lng, heading, save_path = job
+    if CHECK_COVERAGE:
+        # The metadata lookup is an API request too, so it draws from the same limit
+        limiter.acquire()
+        if not fetch_streetview_metadata(lat, lng):
+            return None
+    limiter.acquire()
+    if not fetch_street_view_image(lat, lng, heading, save_path, pitch=PITCH):
+        return None
+    return job
+
+
+def iter_download_jobs(G, sample_spacing=SPACING_METERS):
+    """
+    Sample points on each edge of G and yield a download job (metadata row) for every
+    image that does not exist yet: (segment_id, u, v, k, index, lat, lng, heading, save_path).
     """
+    # List segment folders once so each edge needs at most one directory syscall
+    existing_folders = {entry.name for entry in os.scandir(IMAGE_DIR) if entry.is_dir()}
     for u, v, k, data in G.edges(keys=True, data=True):
         segment_id = f"{u}_{v}_{k}"
         segment_folder = os.path.join(IMAGE_DIR, segment_id)
-        os.makedirs(segment_folder, exist_ok=True)
+        if segment_id not in existing_folders:
+            os.makedirs(segment_folder, exist_ok=True)
+            existing = set()
+        else:
+            # List the folder once instead of checking every image path
+            existing = set() if OVERWRITE else {
+                entry.name for entry in os.scandir(segment_folder) if entry.name.endswith('.jpg')
+            }
 
         try:
-            points = sample_points_on_edge(G, u, v, k, data, spacing=sample_spacing)
+            coords = edge_coordinates(G, u, v, data)
+            xs, ys, seg_idx = sample_points_on_edge(coords, spacing=sample_spacing)
         except Exception as e:
             print(f"Failed sampling for edge {segment_id}: {e}")
             continue
 
-        # For bearing calculation, get all points including endpoints
-        geom = data.get('geometry')
-        if not geom:
-            point_u = (G.nodes[u]['x'], G.nodes[u]['y'])
-            point_v = (G.nodes[v]['x'], G.nodes[v]['y'])
-            geom = LineString([point_u, point_v])
-        full_points = list(geom.coords)
+        # Segment already complete from a previous run (one image per sampled point)
+        if len(existing) >= len(xs):
+            continue
+
         # If only one point, treat as midpoint between u and v
-        if len(points) == 1:
+        if len(xs) == 1:
             # Use u and v as endpoints
             endpoints = [(G.nodes[u]['y'], G.nodes[u]['x']), (G.nodes[v]['y'], G.nodes[v]['x'])]
-            bearings = [calculate_bearing(*endpoints[0], *endpoints[1])]
+            bearings = [float(calculate_bearing(*endpoints[0], *endpoints[1]))]
         else:
-            # For each sampled point, find the closest segment in the geometry and use its direction
-            bearings = []
-            for pt in points:
-                min_dist = float('inf')
-                best_bearing = 0
-                for i in range(len(full_points) - 1):
-                    x1, y1 = full_points[i]
-                    x2, y2 = full_points[i + 1]
-                    # Distance from pt to segment midpoint
-                    midx = (x1 + x2) / 2
-                    midy = (y1 + y2) / 2
-                    dist = (pt.x - midx) ** 2 + (pt.y - midy) ** 2
-                    if dist < min_dist:
-                        min_dist = dist
-                        best_bearing = calculate_bearing(y1, x1, y2, x2)
-                bearings.append(best_bearing)
-
-        for i, (point, heading) in enumerate(zip(points, bearings)):
-            lat, lng = point.y, point.x
+            # Use the direction of the geometry segment containing each sampled point
+            bearings = segment_bearings(coords)[seg_idx].tolist()
+
+        for i, (lng, lat, heading) in enumerate(zip(xs.tolist(), ys.tolist(), bearings)):
             image_id = f"{i}_{int(round(heading))}"
             filename = f"{image_id}.jpg"
             save_path = os.path.join(segment_folder, filename)
 
-            if os.path.exists(save_path) and not OVERWRITE:
+            if filename in existing:
                 # Skip if image already exists and not overwriting
                 continue
 
-            try:
-                img_bytes = fetch_street_view_image(lat, lng, heading, pitch=PITCH)
-                if img_bytes:
-                    save_image(img_bytes, save_path)
-                    # Append metadata row
-                    with open(METADATA_FILE, "a", newline="") as f:
-                        writer = csv.writer(f)
-                        writer.writerow([
-                            segment_id, u, v, k, i, lat, lng, heading, save_path
-                        ])
-                    time.sleep(0.1)  # Delay to avoid API rate limits
-                else:
-                    print(f"Image not found at {lat}, {lng}, heading {heading}")
-            except Exception as e:
-                print(f"Error fetching image for {segment_id} at {lat},{lng}, heading {heading}: {e}")
+            yield (segment_id, u, v, k, i, lat, lng, heading, save_path)
+
+
+def process_graph_and_download(G, sample_spacing=SPACING_METERS):
+    """
+    For each edge in the OSMnx graph G, sample points, download images, and record metadata.
+    Images are stored in road_images/{segment_id}/{index}_{heading}.jpg
+    Metadata is appended to image_metadata.csv
+    Downloads run concurrently on a thread pool while jobs are still being generated; at most
+    MAX_IN_FLIGHT jobs are pending at once. Samples at the same rounded location and heading
+    are downloaded once and hard-linked. Metadata is written from the main thread only.
+    """
+    print(f"Downloading images using {MAX_WORKERS} threads...")
+    jobs = iter_download_jobs(G, sample_spacing)
+    limiter = RateLimiter(REQUESTS_PER_SECOND)
+    # Keep a single buffered metadata writer open for the whole run
+    with open(METADATA_FILE, "a", newline="", buffering=1 << 20) as f, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        writer = csv.writer(f)
+        rows_written = 0
+        pending = {}
+        seen = {}        # (lat, lng, heading) rounded -> save_path of the job downloading it
+        duplicates = []  # (source save_path, job) pairs linked once downloads finish
+        for job in jobs:
+            segment_id, u, v, k, i, lat, lng, heading, save_path = job
+            key = (round(lat, DEDUP_DECIMALS), round(lng, DEDUP_DECIMALS), int(round(heading)))
+            if key in seen:
+                duplicates.append((seen[key], job))
+                continue
+            seen[key] = save_path
+            pending[executor.submit(download_image, job, limiter)] = job
+            if len(pending) < MAX_IN_FLIGHT:
                 continue
+            # Wait for a slot to free up before generating more jobs
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rows_written += _record_download(future, pending.pop(future), writer)
+            if rows_written >= METADATA_FLUSH_EVERY:
+                f.flush()
+                rows_written = 0
+        for future in wait(pending).done:
+            _record_download(future, pending[future], writer)
+
+        # Co-located samples (e.g. where edge geometries overlap) reuse the downloaded image
+        for source_path, job in duplicates:
+            if not os.path.exists(source_path):
+                continue
+            save_path = job[-1]
+            try:
+                os.link(source_path, save_path)
+            except OSError:
+                shutil.copyfile(source_path, save_path)
+            writer.writerow(job)
+        if duplicates:
+            print(f"Reused {len(duplicates)} images for duplicate sample locations")
+
+
+def _record_download(future, job, writer):
+    """
+    Write the metadata row of a finished download job, or report why it failed.
+    Returns the number of rows written (0 or 1).
+    """
+    segment_id, u, v, k, i, lat, lng, heading, save_path = job
+    try:
+        row = future.result()
+    except Exception as e:
+        print(f"Error fetching image for {segment_id} at {lat},{lng}, heading {heading}: {e}")
+        return 0
+    if row is None:
+        print(f"Image not found at {lat}, {lng}, heading {heading}")
+        return 0
+    writer.writerow(row)
+    return 1
+
+
+def load_road_network(graph_path, pickle_path):
+    """
+    Load the stage 1 road network, preferring the binary pickle over GraphML
+    unless the GraphML file is newer or the pickle cannot be read.
+    """
+    if os.path.exists(pickle_path) and os.path.getmtime(pickle_path) >= os.path.getmtime(graph_path):
+        try:
+            with open(pickle_path, 'rb') as f:
+                return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            print(f"Could not read {pickle_path} ({e}); loading {graph_path} instead")
+    return ox.load_graphml(graph_path)
+
 
 if __name__ == "__main__":
-    import osmnx as ox
     # Load the road network graph
     graph_path = os.path.join("data", "road_network.graphml")
+    pickle_path = os.path.join("data", "road_network.pkl")
     if not os.path.exists(graph_path):
         print(f"GraphML file not found at {graph_path}. Run stage1 to generate it.")
     else:
-        G = ox.load_graphml(graph_path)
-        process_graph_and_download(G)
-        print("Street View image download and metadata collection complete.")
+        G = load_road_network(graph_path, pickle_path)
+        try:
+            process_graph_and_download(G)
+            print("Street View image download and metadata collection complete.")
+        finally:
+            SESSION.close()
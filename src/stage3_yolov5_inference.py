@@ -1,32 +1,91 @@
 import os
 import csv
+import cv2
 import torch
 from pathlib import Path
+from torch.utils.data import DataLoader, Dataset
 
 # -----------------------------
 # CONFIGURATION
 # -----------------------------
 MODEL_PATH = "models/best.pt"           # Path to YOLOv5 model
+# Exported backends, used instead of MODEL_PATH if present (first match wins), e.g.
+#   python yolov5/export.py --weights models/best.pt --include engine --half --device 0 --imgsz 640 --dynamic --batch-size 16
+EXPORTED_MODEL_PATHS = ["models/best.engine", "models/best.onnx"]
+YOLOV5_DIR = os.getenv("YOLOV5_DIR", "yolov5")  # Local clone of ultralytics/yolov5 (used instead of GitHub if present)
 IMAGE_METADATA = "data/image_metadata.csv"   # Metadata CSV from image download stage
 DETECTIONS_CSV = "data/detections.csv"       # Output CSV for detections
+BATCH_SIZE = int(os.getenv("YOLO_BATCH_SIZE", 16))  # Images per inference call (watch GPU memory above 16)
+COMPILE_MODEL = False                        # torch.compile the network on GPU (slow first batch, faster after)
+NUM_WORKERS = min(8, os.cpu_count() or 1)    # DataLoader processes decoding images while the GPU runs
+PREFETCH_BATCHES = 4                         # Batches each worker decodes ahead of inference
 
-# Load YOLOv5 model (from torch hub)
-model = torch.hub.load('ultralytics/yolov5', 'custom', path=MODEL_PATH, force_reload=True)
-
-# Read image metadata
-with open(IMAGE_METADATA, newline='') as f:
-    reader = csv.DictReader(f)
-    image_rows = list(reader)
-
-# Prepare detections CSV
 DETECTION_HEADER = [
     "segment_id", "u", "v", "k", "index", "lat", "lng", "heading", "image_path",
     "class", "confidence", "xmin", "ymin", "xmax", "ymax"
 ]
-with open(DETECTIONS_CSV, "w", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow(DETECTION_HEADER)
 
+
+class StreetViewImages(Dataset):
+    """
+    Decodes Street View images to RGB arrays inside DataLoader worker processes,
+    so JPEG decoding overlaps with inference on the previous batch.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        row, abs_image_path = self.rows[idx]
+        image = cv2.imread(abs_image_path)
+        if image is not None:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return row, abs_image_path, image
+
+
+def collate_images(batch):
+    """
+    Keep the batch as a list of (row, path, image) so AutoShape can letterbox
+    each image itself and rescale boxes back to the original image size.
+    """
+    return batch
+
+
+def load_model():
+    """
+    Load YOLOv5 model, from a local clone if available, otherwise from torch hub
+    (the hub checkout is cached locally after the first run).
+    An exported TensorRT/ONNX model is preferred over the PyTorch weights when present.
+    """
+    model_path = next((path for path in EXPORTED_MODEL_PATHS if os.path.exists(path)), MODEL_PATH)
+    print(f"Loading YOLOv5 model from {model_path}")
+    if os.path.isdir(YOLOV5_DIR):
+        model = torch.hub.load(YOLOV5_DIR, 'custom', path=model_path, source='local')
+    else:
+        model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path)
+    # Exported backends pick their device and precision at load/export time
+    if model_path.endswith(".pt") and torch.cuda.is_available():
+        model.cuda()
+        # Mixed precision: AutoShape runs the forward pass under FP16 autocast
+        model.amp = True
+        if COMPILE_MODEL and hasattr(torch, "compile"):
+            model.model.model = torch.compile(model.model.model, mode="max-autotune")
+    model.eval()
+    return model
+
+
+def load_image_rows(metadata_path):
+    """
+    Read image metadata and resolve image paths up front, dropping missing images.
+    """
+    with open(metadata_path, newline='') as f:
+        reader = csv.DictReader(f)
+        image_rows = list(reader)
+
+    valid_rows = []
     for row in image_rows:
         image_path = row["image_path"]
         # Convert to absolute path relative to project root
@@ -34,17 +93,60 @@ with open(DETECTIONS_CSV, "w", newline="") as f:
         if not os.path.exists(abs_image_path):
             print(f"Image not found: {abs_image_path}")
             continue
-        try:
-            # Run YOLOv5 inference
-            results = model(abs_image_path)
-            detections = results.xyxy[0].cpu().numpy()  # [xmin, ymin, xmax, ymax, conf, cls]
-            for det in detections:
-                xmin, ymin, xmax, ymax, conf, cls = det
-                writer.writerow([
+        valid_rows.append((row, abs_image_path))
+    return valid_rows
+
+
+def run_inference(model, valid_rows, output_path):
+    """
+    Run YOLOv5 over all images in batches and write one CSV row per detection.
+    """
+    loader = DataLoader(
+        StreetViewImages(valid_rows),
+        batch_size=BATCH_SIZE,
+        num_workers=NUM_WORKERS,
+        collate_fn=collate_images,
+        prefetch_factor=PREFETCH_BATCHES if NUM_WORKERS > 0 else None,
+    )
+
+    with open(output_path, "w", newline="", buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(DETECTION_HEADER)
+
+        for loaded in loader:
+            batch = []
+            for row, abs_image_path, image in loaded:
+                if image is None:
+                    print(f"Could not read image: {abs_image_path}")
+                    continue
+                batch.append((row, image))
+            if not batch:
+                continue
+            try:
+                # Run YOLOv5 inference on the whole batch in one call
+                results = model([image for _, image in batch], size=640)
+            except Exception as e:
+                print(f"Error running YOLOv5 on batch starting at {loaded[0][1]}: {e}")
+                continue
+            # Tag each detection with its image index on the device and copy the
+            # whole batch to the CPU in one transfer: [image, xmin, ymin, xmax, ymax, conf, cls]
+            detections = torch.cat([
+                torch.cat([det.new_full((len(det), 1), i), det], dim=1)
+                for i, det in enumerate(results.xyxy)
+            ]).cpu().numpy()
+            batch_rows = []
+            for i, (xmin, ymin, xmax, ymax, conf, cls) in zip(detections[:, 0].astype(int).tolist(), detections[:, 1:].tolist()):
+                row = batch[i][0]
+                batch_rows.append([
                     row["segment_id"], row["u"], row["v"], row["k"], row["index"],
                     row["lat"], row["lng"], row["heading"], row["image_path"],
-                    int(cls), float(conf), float(xmin), float(ymin), float(xmax), float(ymax)
+                    int(cls), conf, xmin, ymin, xmax, ymax
                 ])
-        except Exception as e:
-            print(f"Error running YOLOv5 on {abs_image_path}: {e}")
-            continue
\ No newline at end of file
+            writer.writerows(batch_rows)
+
+
+if __name__ == "__main__":
+    # Guarded so DataLoader workers (spawned on Windows) do not reload the model
+    model = load_model()
+    valid_rows = load_image_rows(IMAGE_METADATA)
+    run_inference(model, valid_rows, DETECTIONS_CSV)
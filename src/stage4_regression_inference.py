@@ -1,11 +1,24 @@
+import os
 import csv
 import joblib
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
 # -----------------------------
 # CONFIGURATION
 # -----------------------------
 REGRESSION_MODEL_PATH = "../models/paser_gb_regressor.joblib"  # Path to regression model
+REGRESSION_ONNX_PATH = "../models/paser_gb_regressor.onnx"     # ONNX export, used if present (utils/export_regressor_onnx.py)
 DETECTIONS_CSV = "../data/detections.csv"                        # Input: YOLOv5 detections
 SCORES_CSV = "../data/proxy_paser_scores_new.csv"                    # Output: PASER scores per image
 
@@ -29,51 +42,76 @@ class_map = {
     6: ("Manhole cover_count", "Manhole cover_total_area"),
 }
 
+
+def build_feature_matrix(image_idx, class_id, area, n_images):
+    """
+    Scatter-add detection counts and box areas into an (n_images, 14) feature matrix.
+    feature_columns holds a (count, total area) pair for each class in class id order;
+    detections of classes outside class_map are ignored.
+    """
+    known = np.isin(class_id, list(class_map))
+    # Index arrays must be integers even when an empty CSV gives the class column another dtype
+    image_idx, class_id, area = image_idx[known].astype(np.intp), class_id[known].astype(np.intp), area[known]
+    features = np.zeros((n_images, len(feature_columns)))
+    np.add.at(features, (image_idx, 2 * class_id), 1.0)
+    np.add.at(features, (image_idx, 2 * class_id + 1), area)
+    return features
+
+
+def load_predictor():
+    """
+    Return a predict function for the regression model.
+    Uses the ONNX Runtime export when it exists and onnxruntime is installed,
+    otherwise the scikit-learn model.
+    """
+    if onnxruntime is not None and os.path.exists(REGRESSION_ONNX_PATH):
+        session = onnxruntime.InferenceSession(REGRESSION_ONNX_PATH, providers=["CPUExecutionProvider"])
+        input_name = session.get_inputs()[0].name
+        return lambda X: session.run(None, {input_name: X})[0].ravel()
+
+    regressor = joblib.load(REGRESSION_MODEL_PATH)
+    if hasattr(regressor, "n_jobs"):
+        # Parallel prediction for ensembles that support it (e.g. random forests)
+        regressor.n_jobs = -1
+    return regressor.predict
+
+
 # Load regression model
-regressor = joblib.load(REGRESSION_MODEL_PATH)
+predict = load_predictor()
+
+# Read detections and aggregate features for each image
+# Each image may have multiple detections; metadata columns are kept as text
+# so they are written back unchanged
+META_COLUMNS = ["segment_id", "u", "v", "k", "index", "lat", "lng", "heading", "image_path"]
+# Arrow's multithreaded parser when installed, otherwise the C parser with exact float parsing
+read_options = {"engine": "pyarrow"} if pyarrow is not None else {"float_precision": "round_trip"}
+detections = pd.read_csv(DETECTIONS_CSV, dtype={col: str for col in META_COLUMNS}, **read_options)
 
-# Read detections and group by image
-# Each image may have multiple detections
-# We'll aggregate features for each image
+# Use metadata from first detection (all detections for image share metadata)
+image_meta = detections.drop_duplicates("image_path")[META_COLUMNS]
+# Feature matrix row of each detection (images in order of first appearance, as in image_meta)
+image_idx, _ = pd.factorize(detections["image_path"])
 
-detections_by_image = {}
-with open(DETECTIONS_CSV, newline='') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        image_path = row["image_path"]
-        if image_path not in detections_by_image:
-            detections_by_image[image_path] = []
-        detections_by_image[image_path].append(row)
+# Count and total area per (image, class)
+area = ((detections["xmax"] - detections["xmin"]) * (detections["ymax"] - detections["ymin"])).to_numpy()
+features = build_feature_matrix(image_idx, detections["class"].to_numpy(), area, len(image_meta))
 
 # Prepare output CSV
 SCORES_HEADER = [
     "segment_id", "u", "v", "k", "index", "lat", "lng", "heading", "image_path", "proxy_paser_score"
 ]
-with open(SCORES_CSV, "w", newline="") as f:
+# Predict proxy PASER scores for all images in a single call
+# (tree ensembles evaluate features as float32 internally)
+X = features.astype(np.float32)
+try:
+    scores = predict(X) if len(X) else []
+except Exception as e:
+    print(f"Error predicting PASER scores: {e}")
+    scores = []
+score_rows = [[*meta, score] for meta, score in zip(image_meta.itertuples(index=False, name=None), scores)]
+
+# Write all scores in one buffered pass
+with open(SCORES_CSV, "w", newline="", buffering=1 << 20) as f:
     writer = csv.writer(f)
     writer.writerow(SCORES_HEADER)
-
-    for image_path, detections in detections_by_image.items():
-        # Initialize features
-        features = {col: 0 for col in feature_columns}
-        for det in detections:
-            cls = int(det["class"])
-            area = (float(det["xmax"]) - float(det["xmin"])) * (float(det["ymax"]) - float(det["ymin"]))
-            count_col, area_col = class_map.get(cls, (None, None))
-            if count_col and area_col:
-                features[count_col] += 1
-                features[area_col] += area
-        # Prepare feature vector in correct order
-        feature_vector = [features[col] for col in feature_columns]
-        try:
-            # Predict proxy PASER score for this image
-            score = regressor.predict([feature_vector])[0]
-        except Exception as e:
-            print(f"Error predicting PASER score for {image_path}: {e}")
-            continue
-        # Use metadata from first detection (all detections for image share metadata)
-        meta = detections[0]
-        writer.writerow([
-            meta["segment_id"], meta["u"], meta["v"], meta["k"], meta["index"],
-            meta["lat"], meta["lng"], meta["heading"], meta["image_path"], score
-        ])
\ No newline at end of file
+    writer.writerows(score_rows)
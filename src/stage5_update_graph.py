@@ -9,10 +9,10 @@ Configuration is set via constants at the top of the script.
 """
 
 import os
-import csv
+import numpy as np
 import osmnx as ox
+import pandas as pd
 import networkx as nx
-from collections import defaultdict
 
 # -----------------------------
 # CONFIGURATION
@@ -27,27 +27,17 @@ def load_paser_scores(csv_path):
     Returns a dictionary mapping (u, v, k) tuples to PASER scores.
     """
     print(f"Loading PASER scores from {csv_path}")
-    paser_scores = defaultdict(list)
-    
-    with open(csv_path, 'r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            u = row['u']
-            v = row['v'] 
-            k = int(row['k'])
-            score = float(row['proxy_paser_score'])
-            
-            # Group scores by edge (u, v, k)
-            edge_key = (u, v, k)
-            paser_scores[edge_key].append(score)
-    
-    # Calculate average score for each edge
-    avg_scores = {}
-    for edge_key, scores in paser_scores.items():
-        avg_scores[edge_key] = sum(scores) / len(scores)
-        print(f"Edge {edge_key}: {len(scores)} images, avg PASER score: {avg_scores[edge_key]:.2f}")
-    
-    print(f"Loaded PASER scores for {len(avg_scores)} edges")
+    scores = pd.read_csv(
+        csv_path,
+        usecols=['u', 'v', 'k', 'proxy_paser_score'],
+        dtype={'u': str, 'v': str, 'k': int, 'proxy_paser_score': float},
+    )
+
+    # Average score for each edge over all of its images, keyed by (str(u), str(v), int(k))
+    grouped = scores.groupby(['u', 'v', 'k'], sort=False)['proxy_paser_score'].mean()
+    avg_scores = {(u, v, int(k)): score for (u, v, k), score in grouped.items()}
+
+    print(f"Loaded PASER scores for {len(avg_scores)} edges from {len(scores)} images")
     return avg_scores
 
 def update_graph_with_paser(graph, paser_scores):
@@ -58,32 +48,21 @@ def update_graph_with_paser(graph, paser_scores):
     """
     print("Updating graph edges with PASER scores...")
     updated_edges = 0
-    total_edges = len(graph.edges())
+    total_edges = 0
     
     for u, v, k, data in graph.edges(keys=True, data=True):
-        # Try both string and integer versions of node IDs
-        edge_keys_to_try = [
-            (str(u), str(v), k),
-            (u, v, k),
-            (int(u) if str(u).isdigit() else u, int(v) if str(v).isdigit() else v, k)
-        ]
-        
-        paser_score = None
-        for edge_key in edge_keys_to_try:
-            if edge_key in paser_scores:
-                paser_score = paser_scores[edge_key]
-                break
-        
-        if paser_score is not None:
-            data['paser_score'] = paser_score
-            # Store inverted PASER score for optimization (lower PASER = higher cost)
-            # PASER 1 (very poor) -> inverted = 10, PASER 10 (excellent) -> inverted = 1
-            data['inverted_paser'] = 11 - paser_score
-            updated_edges += 1
-        else:
+        total_edges += 1
+        # Scores are keyed by string node IDs, as read from the CSV
+        paser_score = paser_scores.get((str(u), str(v), k))
+        if paser_score is None:
             # Default PASER score for edges without data (neutral/good condition)
-            data['paser_score'] = 5.0  # Middle score (1-10 scale, 5 = fair condition)
-            data['inverted_paser'] = 11 - 5.0  # Inverted default score
+            paser_score = 5.0  # Middle score (1-10 scale, 5 = fair condition)
+        else:
+            updated_edges += 1
+        data['paser_score'] = paser_score
+        # Store inverted PASER score for optimization (lower PASER = higher cost)
+        # PASER 1 (very poor) -> inverted = 10, PASER 10 (excellent) -> inverted = 1
+        data['inverted_paser'] = 11 - paser_score
     
     print(f"Updated {updated_edges}/{total_edges} edges with PASER scores")
     print(f"Remaining {total_edges - updated_edges} edges assigned default score of 5.0")
@@ -96,17 +75,17 @@ def calculate_weighted_travel_time(graph):
     """
     print("Calculating weighted travel times based on PASER scores...")
     
-    for u, v, k, data in graph.edges(keys=True, data=True):
-        base_time = data.get('travel_time', 0)
-        paser_score = data.get('paser_score', 5.0)
-        
-        # Weight factor: worse pavement (lower PASER) increases travel time
-        # PASER scale: 1 (very poor) to 10 (excellent)
-        # Weight factor ranges from 1.5 (poor) to 1.0 (excellent)
-        weight_factor = 2.0 - (paser_score / 10.0)
-        weighted_time = base_time * weight_factor
-        
-        data['weighted_travel_time'] = weighted_time
+    edges = list(graph.edges(data=True))
+    base_time = np.fromiter((data.get('travel_time', 0) for _, _, data in edges), dtype=float, count=len(edges))
+    paser_score = np.fromiter((data.get('paser_score', 5.0) for _, _, data in edges), dtype=float, count=len(edges))
+    
+    # Weight factor: worse pavement (lower PASER) increases travel time
+    # PASER scale: 1 (very poor) to 10 (excellent)
+    # Weight factor ranges from 1.5 (poor) to 1.0 (excellent)
+    weighted_time = base_time * (2.0 - paser_score / 10.0)
+    
+    for (_, _, data), value in zip(edges, weighted_time.tolist()):
+        data['weighted_travel_time'] = value
     
     print("Calculated weighted travel times for all edges")
 
@@ -163,19 +142,23 @@ def update_road_network_with_paser():
         print(f"Updated graph saved to {OUTPUT_PATH}")
         
         # Print summary statistics
-        paser_scores_list = [data.get('paser_score', 5.0) for u, v, k, data in graph.edges(keys=True, data=True)]
-        inverted_paser_scores_list = [data.get('inverted_paser', 6.0) for u, v, k, data in graph.edges(keys=True, data=True)]
-        avg_paser = sum(paser_scores_list) / len(paser_scores_list)
-        min_paser = min(paser_scores_list)
-        max_paser = max(paser_scores_list)
-        avg_inverted_paser = sum(inverted_paser_scores_list) / len(inverted_paser_scores_list)
-        min_inverted_paser = min(inverted_paser_scores_list)
-        max_inverted_paser = max(inverted_paser_scores_list)
+        # Both score columns from a single pass over the edges
+        edge_scores = np.array([
+            (data.get('paser_score', 5.0), data.get('inverted_paser', 6.0))
+            for _, _, data in graph.edges(data=True)
+        ]).reshape(-1, 2)
+        paser_values, inverted_paser_values = edge_scores.T
+        avg_paser = paser_values.mean()
+        min_paser = paser_values.min()
+        max_paser = paser_values.max()
+        avg_inverted_paser = inverted_paser_values.mean()
+        min_inverted_paser = inverted_paser_values.min()
+        max_inverted_paser = inverted_paser_values.max()
         
         print(f"\nPASER Score Statistics:")
         print(f"Original PASER - Average: {avg_paser:.2f}, Range: {min_paser:.2f} - {max_paser:.2f}")
         print(f"Inverted PASER - Average: {avg_inverted_paser:.2f}, Range: {min_inverted_paser:.2f} - {max_inverted_paser:.2f}")
-        print(f"Total edges: {len(paser_scores_list)}")
+        print(f"Total edges: {len(paser_values)}")
         
     except Exception as e:
         print(f"Error saving updated graph: {e}")
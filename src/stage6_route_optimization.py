@@ -10,17 +10,28 @@ Configuration is set via constants at the top of the script.
 """
 
 import os
+import json
+import zipfile
 import osmnx as ox
 import networkx as nx
 import numpy as np
 import matplotlib.pyplot as plt
 from typing import Tuple, List, Optional
 
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # -----------------------------
 # CONFIGURATION
 # -----------------------------
 UPDATED_NETWORK_PATH = "data/updated_road_network.graphml"  # Input: Graph with PASER scores
 OUTPUT_PATH = "data/optimized_route.json"                   # Output: Optimized route data
+ROUTING_CACHE_PATH = "data/road_network.csr.npz"            # Cache: routing arrays (rebuilt when the graph is newer)
 
 # ROC-based weights (Rank Order Centroid method)
 # Based on priority: 1) Pavement condition (PASER), 2) Elevation gain, 3) Distance
@@ -28,6 +39,9 @@ ALPHA = 0.611  # Weight for normalized PASER (pavement condition) - highest prio
 BETA = 0.278   # Weight for normalized elevation gain - medium priority  
 GAMMA = 0.111  # Weight for normalized distance - lowest priority
 
+# Custom edge attributes from stages 1 and 5, parsed as floats on load
+EDGE_DTYPES = {'distance': float, 'paser_score': float, 'inverted_paser': float}
+
 # Route optimization parameters
 START_NODE = None    # Will be set dynamically or by user input
 END_NODE = None      # Will be set dynamically or by user input
@@ -42,167 +56,205 @@ def load_road_network_with_paser(graph_path: str) -> nx.MultiDiGraph:
         raise FileNotFoundError(f"Graph file not found: {graph_path}")
     
     try:
-        graph = ox.load_graphml(graph_path)
+        # Convert the attributes written by earlier stages once here, since GraphML
+        # stores custom attributes as strings (osmnx already converts length and elevation)
+        graph = ox.load_graphml(graph_path, edge_dtypes=EDGE_DTYPES)
         print(f"Loaded graph with {len(graph.nodes())} nodes and {len(graph.edges())} edges")
         return graph
     except Exception as e:
         raise Exception(f"Error loading graph: {e}")
 
-def calculate_elevation_gain(graph: nx.MultiDiGraph) -> nx.MultiDiGraph:
+def build_composite_weights(graph: nx.MultiDiGraph) -> Tuple[nx.MultiDiGraph, tuple]:
     """
-    Calculate elevation gain for each edge, considering only uphill segments.
-    Negative elevation gains (downhill) are set to zero.
+    Calculate elevation gain, Min-Max normalized attributes, and composite weights
+    for all edges in a single pass over the graph, using ROC-based coefficients:
+    composite_weight = α × norm_PASER + β × norm_elev + γ × norm_dist
+    where α=0.611, β=0.278, γ=0.111
+    Returns the graph and the route edge table used by analyze_route_composition.
     """
-    print("Calculating elevation gain for edges...")
+    print("Building composite edge weights...")
     
-    for u, v, k, data in graph.edges(keys=True, data=True):
-        # Get elevation data from nodes
-        elev_u = graph.nodes[u].get('elevation', 0)
-        elev_v = graph.nodes[v].get('elevation', 0)
-        
-        try:
-            elev_u = float(elev_u)
-            elev_v = float(elev_v)
-            
-            # Calculate elevation gain (only positive gains considered)
-            elevation_gain = max(0, elev_v - elev_u)
-            data['elevation_gain'] = elevation_gain
-            
-        except (TypeError, ValueError):
-            # If elevation data is missing or invalid, set to 0
-            data['elevation_gain'] = 0.0
+    # Extract edge attributes into arrays aligned with the edge list
+    # (default inverted PASER = 6 (fair); handle both 'length' and 'distance' attributes)
+    edges = list(graph.edges(data=True))
+    paser_values = np.array([data.get('inverted_paser', 6.0) for _, _, data in edges], dtype=float)
+    distance_values = np.array([data.get('length', data.get('distance', 0.0)) for _, _, data in edges], dtype=float)
     
-    print("Calculated elevation gain for all edges")
-    return graph
-
-def normalize_edge_attributes(graph: nx.MultiDiGraph) -> nx.MultiDiGraph:
-    """
-    Normalize inverted PASER scores, elevation gain, and distance using Min-Max normalization.
-    """
-    print("Normalizing edge attributes...")
-    
-    # Collect all values for normalization
-    paser_values = []
-    elev_gain_values = []
-    distance_values = []
-    
-    for u, v, k, data in graph.edges(keys=True, data=True):
-        # Convert inverted PASER to float to handle string values from GraphML
-        inverted_paser = data.get('inverted_paser', 6.0)
-        try:
-            inverted_paser = float(inverted_paser)
-        except (TypeError, ValueError):
-            inverted_paser = 6.0  # Default inverted PASER = 6 (fair)
-        
-        paser_values.append(inverted_paser)
-        elev_gain_values.append(data.get('elevation_gain', 0.0))
-        # Handle both 'length' and 'distance' attributes, convert to float
-        distance = data.get('length', data.get('distance', 0.0))
-        try:
-            distance = float(distance)
-        except (TypeError, ValueError):
-            distance = 0.0
-        distance_values.append(distance)
+    # Node elevations indexed by contiguous node id, gathered per edge endpoint
+    node_index = {node: i for i, node in enumerate(graph.nodes)}
+    node_elev = np.fromiter(
+        (elev for _, elev in graph.nodes(data='elevation', default=0.0)), dtype=float, count=len(node_index)
+    )
+    u_idx = np.fromiter((node_index[u] for u, _, _ in edges), dtype=np.intp, count=len(edges))
+    v_idx = np.fromiter((node_index[v] for _, v, _ in edges), dtype=np.intp, count=len(edges))
+    
+    # Elevation gain: only uphill segments count (downhill and missing elevation give 0)
+    elev_diff = node_elev[v_idx] - node_elev[u_idx]
+    elev_gain_values = np.where(elev_diff > 0, elev_diff, 0.0)
     
     # Calculate min and max values
-    min_paser, max_paser = min(paser_values), max(paser_values)
-    min_elev, max_elev = min(elev_gain_values), max(elev_gain_values)
-    min_dist, max_dist = min(distance_values), max(distance_values)
+    min_paser, max_paser = paser_values.min(), paser_values.max()
+    min_elev, max_elev = elev_gain_values.min(), elev_gain_values.max()
+    min_dist, max_dist = distance_values.min(), distance_values.max()
     
     print(f"Inverted PASER range: {min_paser:.2f} - {max_paser:.2f}")
     print(f"Elevation gain range: {min_elev:.2f} - {max_elev:.2f} meters")
     print(f"Distance range: {min_dist:.2f} - {max_dist:.2f} meters")
     
-    # Normalize values for each edge
-    for u, v, k, data in graph.edges(keys=True, data=True):
-        inverted_paser = data.get('inverted_paser', 6.0)
-        # Convert to float to handle string values from GraphML
-        try:
-            inverted_paser = float(inverted_paser)
-        except (TypeError, ValueError):
-            inverted_paser = 6.0
-            
-        elev_gain = data.get('elevation_gain', 0.0)
-        distance = data.get('length', data.get('distance', 0.0))
-        
-        # Convert to float to handle string values
-        try:
-            distance = float(distance)
-        except (TypeError, ValueError):
-            distance = 0.0
-        
-        # Min-Max normalization
-        # Inverted PASER: normalize to [0,1] where 0=excellent, 1=worst
-        if max_paser > min_paser:
-            norm_paser = (inverted_paser - min_paser) / (max_paser - min_paser)
-        else:
-            norm_paser = 0.0
-        
-        # Elevation gain: normalize to [0,1] where 0=flat, 1=steepest
-        norm_elev = elev_gain / max_elev if max_elev > 0 else 0.0
-        
-        # Distance: normalize to [0,1] where 0=shortest, 1=longest
-        if max_dist > min_dist:
-            norm_dist = (distance - min_dist) / (max_dist - min_dist)
-        else:
-            norm_dist = 0.0
-        
-        # Store normalized values
-        data['norm_paser'] = norm_paser
-        data['norm_elev'] = norm_elev
-        data['norm_dist'] = norm_dist
+    # Min-Max normalization
+    # Inverted PASER: normalize to [0,1] where 0=excellent, 1=worst
+    if max_paser > min_paser:
+        norm_paser = (paser_values - min_paser) / (max_paser - min_paser)
+    else:
+        norm_paser = np.zeros_like(paser_values)
     
-    print("Completed normalization of edge attributes")
-    return graph
-
-def calculate_composite_weights(graph: nx.MultiDiGraph) -> nx.MultiDiGraph:
-    """
-    Calculate composite weights using ROC-based coefficients.
-    composite_weight = α × norm_PASER + β × norm_elev + γ × norm_dist
-    where α=0.611, β=0.278, γ=0.111
-    """
-    print("Calculating composite weights using ROC method...")
+    # Elevation gain: normalize to [0,1] where 0=flat, 1=steepest
+    norm_elev = elev_gain_values / max_elev if max_elev > 0 else np.zeros_like(elev_gain_values)
+    
+    # Distance: normalize to [0,1] where 0=shortest, 1=longest
+    if max_dist > min_dist:
+        norm_dist = (distance_values - min_dist) / (max_dist - min_dist)
+    else:
+        norm_dist = np.zeros_like(distance_values)
+    
+    # Calculate composite weight using ROC coefficients
     print(f"ROC coefficients: α={ALPHA:.3f} (PASER), β={BETA:.3f} (elevation), γ={GAMMA:.3f} (distance)")
+    composite_weights = ALPHA * norm_paser + BETA * norm_elev + GAMMA * norm_dist
     
-    composite_weights = []
+    # Store elevation gain and composite weight in one write pass (the normalized values
+    # stay local), remembering the first edge row for each (u, v) pair for route analysis
+    first_edge_index = {}
+    for i, ((u, v, data), gain, w) in enumerate(zip(edges, elev_gain_values.tolist(), composite_weights.tolist())):
+        data['elevation_gain'] = gain
+        data['composite_weight'] = w
+        first_edge_index.setdefault((u, v), i)
     
-    for u, v, k, data in graph.edges(keys=True, data=True):
-        norm_paser = data.get('norm_paser', 0.0)
-        norm_elev = data.get('norm_elev', 0.0)
-        norm_dist = data.get('norm_dist', 0.0)
-        
-        # Calculate composite weight using ROC coefficients
-        composite_weight = (ALPHA * norm_paser + 
-                          BETA * norm_elev + 
-                          GAMMA * norm_dist)
-        
-        data['composite_weight'] = composite_weight
-        composite_weights.append(composite_weight)
+    # Per-edge table used by analyze_route_composition:
+    # columns [distance, elevation_gain, paser_score, composite_weight]
+    paser_scores = np.array([data.get('paser_score', 5.0) for _, _, data in edges], dtype=float)
+    edge_table = np.column_stack((distance_values, elev_gain_values, paser_scores, composite_weights))
     
     # Print statistics
-    avg_weight = np.mean(composite_weights)
-    min_weight = np.min(composite_weights)
-    max_weight = np.max(composite_weights)
-    
     print(f"Composite weight statistics:")
-    print(f"  Average: {avg_weight:.4f}")
-    print(f"  Range: {min_weight:.4f} - {max_weight:.4f}")
+    print(f"  Average: {composite_weights.mean():.4f}")
+    print(f"  Range: {composite_weights.min():.4f} - {composite_weights.max():.4f}")
     print(f"  Total edges with weights: {len(composite_weights)}")
     
-    return graph
+    return graph, (first_edge_index, edge_table)
 
-def find_optimal_route(graph: nx.MultiDiGraph, start_node: str, end_node: str) -> Tuple[List[str], float]:
+def build_weight_matrix(graph: nx.MultiDiGraph) -> Tuple[list, dict, "csr_matrix"]:
+    """
+    Build a CSR adjacency matrix of composite weights over contiguous node indices.
+    Parallel edges keep their lowest weight, as in NetworkX's multigraph Dijkstra.
+    """
+    nodes = list(graph.nodes())
+    node_index = {node: i for i, node in enumerate(nodes)}
+    edges = list(graph.edges(data='composite_weight', default=1.0))
+    rows = np.fromiter((node_index[u] for u, _, _ in edges), dtype=np.int32, count=len(edges))
+    cols = np.fromiter((node_index[v] for _, v, _ in edges), dtype=np.int32, count=len(edges))
+    weights = np.fromiter((w for _, _, w in edges), dtype=np.float64, count=len(edges))
+    
+    # Sort by (row, col, weight) and keep the first entry of each (row, col) pair,
+    # since csr_matrix would otherwise sum the weights of parallel edges
+    order = np.lexsort((weights, cols, rows))
+    rows, cols, weights = rows[order], cols[order], weights[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    matrix = csr_matrix((weights[first], (rows[first], cols[first])), shape=(len(nodes), len(nodes)))
+    return nodes, node_index, matrix
+
+def save_routing_cache(weight_matrix: tuple, route_edge_table: tuple, cache_path: str):
+    """
+    Save the CSR weight matrix, node IDs, and route analysis rows to a compressed .npz file
+    so later runs can skip GraphML parsing and edge preprocessing.
+    """
+    nodes, node_index, matrix = weight_matrix
+    node_ids = np.asarray(nodes)
+    if node_ids.dtype == object:
+        # Mixed node ID types cannot be stored without pickling
+        return
+    
+    # Keep only the analysis rows of the first edge between each node pair
+    first_edge_index, edge_table = route_edge_table
+    pairs = np.array([(node_index[u], node_index[v]) for u, v in first_edge_index], dtype=np.int64).reshape(-1, 2)
+    rows = np.fromiter(first_edge_index.values(), dtype=np.intp, count=len(first_edge_index))
+    
+    # Write to a temporary file first so an interrupted save never leaves a broken cache
+    tmp_path = cache_path + ".part"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(
+            f,
+            node_ids=node_ids,
+            indptr=matrix.indptr,
+            indices=matrix.indices,
+            weights=matrix.data,
+            edge_pairs=pairs,
+            edge_table=edge_table[rows],
+            roc_weights=np.array([ALPHA, BETA, GAMMA]),
+        )
+    os.replace(tmp_path, cache_path)
+    print(f"Saved routing cache to {cache_path}")
+
+def load_routing_cache(cache_path: str, graph_path: str) -> Optional[Tuple[nx.MultiDiGraph, tuple, tuple]]:
+    """
+    Load the arrays saved by save_routing_cache as a node-only graph, the weight matrix,
+    and the route analysis table. Returns None if the cache is missing, unreadable, older
+    than the GraphML file, or was built with different ROC weights.
+    """
+    if not os.path.exists(cache_path) or not os.path.exists(graph_path):
+        return None
+    if os.path.getmtime(cache_path) < os.path.getmtime(graph_path):
+        return None
+    
+    try:
+        with np.load(cache_path) as cache:
+            if not np.array_equal(cache['roc_weights'], [ALPHA, BETA, GAMMA]):
+                return None
+            nodes = cache['node_ids'].tolist()
+            matrix = csr_matrix((cache['weights'], cache['indices'], cache['indptr']), shape=(len(nodes), len(nodes)))
+            edge_pairs = cache['edge_pairs'].tolist()
+            edge_table = cache['edge_table']
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+        # Treat a corrupt or incomplete cache as a miss; it is rewritten after the rebuild
+        print(f"Ignoring unreadable routing cache {cache_path}: {e}")
+        return None
+    
+    graph = nx.MultiDiGraph()
+    graph.add_nodes_from(nodes)
+    node_index = {node: i for i, node in enumerate(nodes)}
+    first_edge_index = {(nodes[u], nodes[v]): row for row, (u, v) in enumerate(edge_pairs)}
+    print(f"Loaded routing cache from {cache_path} with {len(nodes)} nodes and {matrix.nnz} weighted node pairs")
+    return graph, (nodes, node_index, matrix), (first_edge_index, edge_table)
+
+def _shortest_path_csr(weight_matrix: tuple, start_node: str, end_node: str) -> Tuple[List[str], float]:
+    """
+    Run SciPy's C implementation of Dijkstra on the CSR weight matrix
+    and rebuild the node path from the predecessor array.
+    """
+    nodes, node_index, matrix = weight_matrix
+    for node in (start_node, end_node):
+        if node not in node_index:
+            raise nx.NodeNotFound(f"Node {node} not in graph")
+    start_idx, end_idx = node_index[start_node], node_index[end_node]
+    
+    distances, predecessors = dijkstra(matrix, directed=True, indices=start_idx, return_predecessors=True)
+    if np.isinf(distances[end_idx]):
+        raise nx.NetworkXNoPath(f"No path between {start_node} and {end_node}")
+    
+    path = [end_idx]
+    while path[-1] != start_idx:
+        path.append(predecessors[path[-1]])
+    return [nodes[i] for i in reversed(path)], float(distances[end_idx])
+
+def find_optimal_route(weight_matrix: tuple, start_node: str, end_node: str) -> Tuple[List[str], float]:
     """
     Find the optimal route using modified Dijkstra's algorithm with composite weights.
+    Uses SciPy's sparse-graph Dijkstra over the weight matrix from build_weight_matrix.
     """
     print(f"Finding optimal route from {start_node} to {end_node}...")
     
     try:
-        # Use NetworkX shortest path with composite weights
-        path = nx.shortest_path(graph, start_node, end_node, weight='composite_weight')
-        
-        # Calculate total route cost
-        total_cost = nx.shortest_path_length(graph, start_node, end_node, weight='composite_weight')
+        path, total_cost = _shortest_path_csr(weight_matrix, start_node, end_node)
         
         print(f"Optimal route found with {len(path)} nodes and total cost: {total_cost:.4f}")
         return path, total_cost
@@ -214,55 +266,30 @@ def find_optimal_route(graph: nx.MultiDiGraph, start_node: str, end_node: str) -
         print(f"Error finding route: {e}")
         return [], float('inf')
 
-def analyze_route_composition(graph: nx.MultiDiGraph, path: List[str]) -> dict:
+def analyze_route_composition(route_edge_table: tuple, path: List[str]) -> dict:
     """
-    Analyze the composition of the optimal route in terms of PASER scores, elevation, and distance.
+    Analyze the composition of the optimal route in terms of PASER scores, elevation, and distance,
+    using the route edge table from build_composite_weights.
     """
     if len(path) < 2:
         return {}
     
     print("Analyzing route composition...")
     
-    total_distance = 0.0
-    total_elevation_gain = 0.0
-    paser_scores = []
-    composite_weights = []
-    
-    for i in range(len(path) - 1):
-        u, v = path[i], path[i + 1]
-        
-        # Find the edge data (handle multi-edges)
-        edge_data = None
-        if graph.has_edge(u, v):
-            # Get the first edge if multiple exist
-            edge_data = graph[u][v][0]
-        
-        if edge_data:
-            # Convert distance to float to handle string values
-            distance = edge_data.get('length', edge_data.get('distance', 0.0))
-            try:
-                distance = float(distance)
-            except (TypeError, ValueError):
-                distance = 0.0
-            
-            total_distance += distance
-            total_elevation_gain += edge_data.get('elevation_gain', 0.0)
-            
-            # Convert PASER score to float
-            paser_score = edge_data.get('paser_score', 5.0)
-            try:
-                paser_score = float(paser_score)
-            except (TypeError, ValueError):
-                paser_score = 5.0
-            
-            paser_scores.append(paser_score)
-            composite_weights.append(edge_data.get('composite_weight', 0.0))
+    # Table rows of the first edge between each pair of consecutive nodes
+    first_edge_index, edge_table = route_edge_table
+    rows = np.array(
+        [first_edge_index[pair] for pair in zip(path[:-1], path[1:]) if pair in first_edge_index], dtype=np.intp
+    )
+    segments = edge_table[rows]
+    total_distance, total_elevation_gain = segments[:, 0].sum(), segments[:, 1].sum()
+    paser_scores, composite_weights = segments[:, 2], segments[:, 3]
     
     analysis = {
         'total_distance_m': total_distance,
         'total_elevation_gain_m': total_elevation_gain,
-        'average_paser_score': np.mean(paser_scores) if paser_scores else 5.0,
-        'average_composite_weight': np.mean(composite_weights) if composite_weights else 0.0,
+        'average_paser_score': paser_scores.mean() if len(paser_scores) else 5.0,
+        'average_composite_weight': composite_weights.mean() if len(composite_weights) else 0.0,
         'num_segments': len(path) - 1
     }
     
@@ -301,17 +328,24 @@ def optimize_cycling_route():
     print("=== Stage 6: Route Optimization using Modified Dijkstra's Algorithm ===")
     
     try:
-        # Load road network with PASER scores (including inverted scores from Stage 5)
-        graph = load_road_network_with_paser(UPDATED_NETWORK_PATH)
+        # Reuse the routing arrays from a previous run if the graph has not changed
+        cached = load_routing_cache(ROUTING_CACHE_PATH, UPDATED_NETWORK_PATH)
         
-        # Calculate elevation gain for edges
-        graph = calculate_elevation_gain(graph)
-        
-        # Normalize edge attributes
-        graph = normalize_edge_attributes(graph)
-        
-        # Calculate composite weights using ROC method
-        graph = calculate_composite_weights(graph)
+        if cached is not None:
+            graph, weight_matrix, route_edge_table = cached
+        else:
+            # Load road network with PASER scores (including inverted scores from Stage 5)
+            graph = load_road_network_with_paser(UPDATED_NETWORK_PATH)
+            
+            # Calculate elevation gain, normalized attributes, and ROC composite weights
+            graph, route_edge_table = build_composite_weights(graph)
+            weight_matrix = build_weight_matrix(graph)
+            
+            try:
+                save_routing_cache(weight_matrix, route_edge_table, ROUTING_CACHE_PATH)
+            except Exception as e:
+                # The cache only speeds up later runs, so still compute this route
+                print(f"Could not save routing cache to {ROUTING_CACHE_PATH}: {e}")
         
         # Get route start and end points
         start_node, end_node = get_route_nodes_interactive(graph)
@@ -321,14 +355,14 @@ def optimize_cycling_route():
             return
         
         # Find optimal route
-        optimal_path, total_cost = find_optimal_route(graph, start_node, end_node)
+        optimal_path, total_cost = find_optimal_route(weight_matrix, start_node, end_node)
         
         if not optimal_path:
             print("No optimal route found")
             return
         
         # Analyze route composition
-        route_analysis = analyze_route_composition(graph, optimal_path)
+        route_analysis = analyze_route_composition(route_edge_table, optimal_path)
         
         # Save results
         save_route_results(optimal_path, total_cost, route_analysis, start_node, end_node)
@@ -341,9 +375,8 @@ def optimize_cycling_route():
 def save_route_results(path: List[str], cost: float, analysis: dict, start: str, end: str):
     """
     Save route optimization results to JSON file.
+    Uses orjson's C serializer when installed, otherwise the standard json module.
     """
-    import json
-    
     results = {
         'route': {
             'start_node': start,
@@ -364,8 +397,12 @@ def save_route_results(path: List[str], cost: float, analysis: dict, start: str,
     
     try:
         os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
-        with open(OUTPUT_PATH, 'w') as f:
-            json.dump(results, f, indent=2)
+        if orjson is not None:
+            with open(OUTPUT_PATH, 'wb') as f:
+                f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+        else:
+            with open(OUTPUT_PATH, 'w') as f:
+                json.dump(results, f, indent=2)
         print(f"Route results saved to {OUTPUT_PATH}")
     except Exception as e:
         print(f"Error saving results: {e}")
@@ -3,10 +3,21 @@ import networkx as nx
 import osmnx as ox
 import os
 
+MAX_NODE_LABELS = 500  # Above this many nodes, only intersections are labeled (up to this many)
+
+def nodes_to_label(graph, max_labels=MAX_NODE_LABELS):
+    # Label every node on small graphs; on large graphs label only intersections,
+    # since tens of thousands of text artists make rendering unusably slow
+    if graph.number_of_nodes() <= max_labels:
+        return list(graph.nodes())
+    intersections = [node for node, streets in graph.nodes(data='street_count', default=0) if streets >= 3]
+    return intersections[:max_labels]
+
 def display_graph(graph, node_label_color="white", edge_color="gray"):
     fig, ax = ox.plot_graph(graph, edge_linewidth=1, edge_color=edge_color, show=False, close=False)
-    pos = {node: (data['x'], data['y']) for node, data in graph.nodes(data=True)}
-    node_labels = {node: str(node) for node in graph.nodes()}
+    labeled = nodes_to_label(graph)
+    pos = {node: (graph.nodes[node]['x'], graph.nodes[node]['y']) for node in labeled}
+    node_labels = {node: str(node) for node in labeled}
     nx.draw_networkx_labels(graph, pos=pos, labels=node_labels, ax=ax, font_size=8, font_color=node_label_color)
     plt.show()
 
@@ -18,10 +29,6 @@ if __name__ == "__main__":
         try:
             G = ox.load_graphml(graph_path)
             print("Loaded graph from data/road_network.graphml")
-            fig, ax = ox.plot_graph(G, edge_linewidth=1, edge_color="gray", show=False, close=False)
-            pos = {node: (data['x'], data['y']) for node, data in G.nodes(data=True)}
-            node_labels = {node: str(node) for node in G.nodes()}
-            nx.draw_networkx_labels(G, pos=pos, labels=node_labels, ax=ax, font_size=8, font_color="white")
-            plt.show()
+            display_graph(G)
         except Exception as e:
             print(f"Error loading or displaying graph: {e}")
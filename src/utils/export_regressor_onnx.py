@@ -0,0 +1,23 @@
+"""
+One-time export of the stage 4 PASER regressor to ONNX, so stage4_regression_inference.py
+can predict with ONNX Runtime instead of scikit-learn.
+Requires skl2onnx; run from the src directory like stage 4.
+"""
+
+import joblib
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
+
+# -----------------------------
+# CONFIGURATION
+# -----------------------------
+REGRESSION_MODEL_PATH = "../models/paser_gb_regressor.joblib"  # Input: scikit-learn regressor
+REGRESSION_ONNX_PATH = "../models/paser_gb_regressor.onnx"     # Output: ONNX model used by stage 4
+NUM_FEATURES = 14                                               # Count/area pair for each of the 7 classes
+
+if __name__ == "__main__":
+    regressor = joblib.load(REGRESSION_MODEL_PATH)
+    onnx_model = convert_sklearn(regressor, initial_types=[("x", FloatTensorType([None, NUM_FEATURES]))])
+    with open(REGRESSION_ONNX_PATH, "wb") as f:
+        f.write(onnx_model.SerializeToString())
+    print(f"Exported regressor to {REGRESSION_ONNX_PATH}")
@@ -0,0 +1,62 @@
+"""
+Shared HTTP session for the Google Maps APIs (Street View, Elevation).
+Successful responses are cached in a local SQLite database when requests-cache
+is installed, so re-running a stage with identical parameters does not hit the network.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+# -----------------------------
+# CONFIGURATION
+# -----------------------------
+HTTP_CACHE_PATH = 'data/http_cache'   # SQLite cache file (".sqlite" is appended)
+HTTP_CACHE_EXPIRE = 30 * 86400        # Cache lifetime in seconds (30 days)
+
+# Google API statuses that are returned with HTTP 200 but must not be cached
+API_ERROR_STATUSES = {"OVER_QUERY_LIMIT", "REQUEST_DENIED", "INVALID_REQUEST", "UNKNOWN_ERROR"}
+
+
+def _is_cacheable(response):
+    """
+    Reject JSON error payloads so transient API errors are retried on the next run,
+    and images, which are already saved to disk and are streamed rather than buffered.
+    """
+    content_type = response.headers.get('Content-Type', '')
+    if content_type.startswith('image/'):
+        return False
+    if 'json' not in content_type:
+        return True
+    try:
+        status = response.json().get('status')
+    except ValueError:
+        return False
+    return status not in API_ERROR_STATUSES
+
+
+def create_session(pool_size=10, cache=True):
+    """
+    Create a requests Session with a connection pool of `pool_size` connections
+    and automatic retries on rate-limit and server errors.
+    The API key is excluded from cache keys (and redacted from stored responses).
+    """
+    if cache and requests_cache is not None:
+        session = requests_cache.CachedSession(
+            HTTP_CACHE_PATH,
+            backend='sqlite',
+            expire_after=HTTP_CACHE_EXPIRE,
+            allowable_codes=(200,),
+            ignored_parameters=['key'],
+            filter_fn=_is_cacheable,
+        )
+    else:
+        session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_maxsize=pool_size, max_retries=retry))
+    return session
@@ -1,5 +1,5 @@
 import rasterio
-from rasterio.plot import show
+from rasterio.enums import Resampling
 from shapely.geometry import Point
 import geopandas as gpd
 
@@ -8,6 +8,7 @@ tisa_coords = (123.871968, 10.299848)  # (lon, lat)
 
 # Load the raster
 raster_path = 'data/srtm.tif'
+preview_max_pixels = 2048  # Longest side of the plotted preview (read from overviews / decimated)
 with rasterio.open(raster_path) as src:
     bounds = src.bounds
     print(f"Raster bounds: {bounds}")
@@ -22,7 +23,14 @@ with rasterio.open(raster_path) as src:
     # Optional: plot raster with point
     try:
         import matplotlib.pyplot as plt
-        show(src, title="SRTM Raster")
+        # Read a downsampled preview instead of loading the full-resolution raster
+        factor = max(1, -(-max(src.width, src.height) // preview_max_pixels))
+        preview = src.read(
+            1, out_shape=(max(1, src.height // factor), max(1, src.width // factor)),
+            resampling=Resampling.average, masked=True
+        )
+        plt.imshow(preview, extent=(bounds.left, bounds.right, bounds.bottom, bounds.top))
+        plt.title("SRTM Raster")
         plt.plot(point.x, point.y, 'ro')  # Mark Tisa point
         plt.show()
     except:
@@ -1,8 +1,9 @@
 import os
-import csv
+import pandas as pd
 from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.collections import PatchCollection
 
 DETECTIONS_CSV = os.path.join(os.path.dirname(__file__), '..', 'detections.csv')
 
@@ -11,18 +12,12 @@ def show_image_with_detections(image_path, detections):
     fig, ax = plt.subplots(1)
     ax.imshow(img)
 
-    for det in detections:
-        xmin = float(det['xmin'])
-        ymin = float(det['ymin'])
-        xmax = float(det['xmax'])
-        ymax = float(det['ymax'])
-        cls = det['class']
-        conf = float(det['confidence'])
-        rect = patches.Rectangle(
-            (xmin, ymin), xmax - xmin, ymax - ymin,
-            linewidth=2, edgecolor='r', facecolor='none'
-        )
-        ax.add_patch(rect)
+    boxes = detections[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy().tolist()
+    # Draw all boxes as one collection instead of one patch artist per detection
+    rects = [patches.Rectangle((xmin, ymin), xmax - xmin, ymax - ymin) for xmin, ymin, xmax, ymax in boxes]
+    ax.add_collection(PatchCollection(rects, linewidth=2, edgecolor='r', facecolor='none'))
+
+    for (xmin, ymin, _, _), cls, conf in zip(boxes, detections['class'], detections['confidence']):
         ax.text(xmin, ymin - 5, f"Class {cls} ({conf:.2f})", color='yellow', fontsize=8, backgroundcolor='black')
 
     plt.title(os.path.basename(image_path))
@@ -30,20 +25,17 @@ def show_image_with_detections(image_path, detections):
     plt.show()
 
 def main():
-    # Group detections by image
-    detections_by_image = {}
+    # Load detections with typed columns and group them by image
     project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-    with open(DETECTIONS_CSV, newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            img_path = row['image_path'].replace("\\", os.sep)
-            abs_img_path = os.path.abspath(os.path.join(project_root, img_path))
-            if abs_img_path not in detections_by_image:
-                detections_by_image[abs_img_path] = []
-            detections_by_image[abs_img_path].append(row)
+    detections = pd.read_csv(DETECTIONS_CSV)
+    abs_paths = {
+        img_path: os.path.abspath(os.path.join(project_root, img_path.replace("\\", os.sep)))
+        for img_path in detections['image_path'].unique()
+    }
+    detections['abs_path'] = detections['image_path'].map(abs_paths)
 
     # Show each image and its detections
-    for img_path, dets in detections_by_image.items():
+    for img_path, dets in detections.groupby('abs_path', sort=False):
         if os.path.exists(img_path):
             print(f"Showing: {img_path}")
             show_image_with_detections(img_path, dets)